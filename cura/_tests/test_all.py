@@ -1,6 +1,6 @@
 import tempfile
 
-from cura.query import _main, load_want
+from cura.query import _main, load_want, parse_filters, symbols_to_bits
 from cura.store import (
     DBMol,
     Store,
@@ -9,15 +9,21 @@ from cura.store import (
     get_elements,
 )
 from cura.utils import (
+    find_library_matches,
     find_matches,
     into_params,
+    make_param,
     mol_from_mapped_smiles,
     mol_from_smiles,
     mol_to_smiles,
+    needs_hs,
+    tanimoto,
 )
+import numpy as np
 from openff.toolkit import ForceField, Molecule, RDKitToolkitWrapper
 from openff.toolkit.utils import ToolkitRegistry, toolkit_registry_manager
-from rdkit import Chem
+from rdkit import Chem, DataStructs
+from rdkit.Chem import AllChem
 
 
 def test_find_matches():
@@ -39,6 +45,35 @@ def test_find_matches():
         assert got == want, f"got = {got}, want = {want}"
 
 
+def test_find_library_matches():
+    params = [
+        make_param(pid, smarts)
+        for pid, smarts in [
+            ("t1", "[*:1]-[#6X4:2]-[#6X4:3]-[*:4]"),
+            ("t2", "[#6X4:1]-[#6X4:2]-[#8X2:3]-[#1:4]"),
+            ("t3", "[*:1]~[#6X3:2]-[#6X4:3]~[*:4]"),
+            ("t4", "[#6X4:1]-[#6X4:2]-[#8X2:3]-[#6:4]"),
+            # overrides every match of t2
+            ("t5", "[#6X4:1]-[#6X4:2]-[#8X2:3]-[#1:4]"),
+        ]
+    ]
+    smiles = ["CCO", "CCOC", "CC(=O)NC", "c1ccccc1CO", "O"]
+    mols = [mol_from_smiles(s) for s in smiles]
+    expected = [find_matches(params, mol) for mol in mols]
+    assert find_library_matches(params, mols) == expected
+
+    # molecules not assigned a wanted parameter may be skipped
+    for want in [{"t2"}, {"t5"}, {"t2", "t4"}, {"t3", "t4"}, {"t9"}]:
+        got = find_library_matches(params, mols, want)
+        for g, e in zip(got, expected):
+            assert want & set(g.values()) == want & set(e.values())
+            if want & set(e.values()):
+                assert g == e
+
+    assert find_library_matches(params, []) == []
+    assert find_library_matches(params, [], {"t1"}) == []
+
+
 def test_load_want():
     got = len(load_want("testfiles/want.params"))
     want = 62
@@ -56,6 +91,15 @@ def test_elements_to_bits():
     assert got == want
 
 
+def test_symbols_to_bits():
+    got = symbols_to_bits(["C", "O"])
+    assert got == elements_to_bits([6, 8])
+
+    # symbols padded with spaces in PTABLE
+    got = symbols_to_bits(["Ds", "Cn"])
+    assert got == elements_to_bits([110, 112])
+
+
 def test_store():
     with tempfile.NamedTemporaryFile() as f:
         s = Store(f.name)
@@ -64,6 +108,17 @@ def test_store():
         got = next(s.get_molecules()).get_elements()
         want = [6, 85]
         assert got == want
+        assert next(s.get_molecules()).inchikey == "inchikey"
+
+
+def test_inchi_filter():
+    # a file with a single key, which loadtxt would load as a 0-d array
+    with tempfile.NamedTemporaryFile("w") as f:
+        f.write("inchikey1\n")
+        f.flush()
+        [filt] = parse_filters([f"inchi:{f.name}"])
+    assert not filt.apply(DBMol("CCO", "inchikey1", 3, 1 << 6 | 1 << 8))
+    assert filt.apply(DBMol("CCCO", "inchikey2", 4, 1 << 6 | 1 << 8))
 
 
 def test_query():
@@ -81,6 +136,97 @@ def test_query():
         assert got == want.matches
 
 
+def test_query_later_want():
+    "Skipping the parameters before the first wanted one keeps the labels"
+    ffname = "openff-2.1.0.offxml"
+    want = {"t9"}
+    molecules = [
+        DBMol.from_rdmol(Chem.MolFromSmiles(smiles), fragment=False)
+        for smiles in ["CCO", "CCCC", "CC(=O)O", "c1ccccc1CO", "CCOC"]
+    ]
+    fragments = [
+        DBMol.from_rdmol(Chem.MolFromSmiles(smiles), fragment=True)
+        for smiles in ["*CCO", "*C(=O)CC"]
+    ]
+    # label with every parameter and only look at the wanted ones afterward
+    params = into_params(ForceField(ffname))
+    entries = [(m, False) for m in molecules] + [(m, True) for m in fragments]
+    expected = dict()
+    for mol, is_frag in entries:
+        matches = find_matches(params, mol_from_smiles(mol.smiles))
+        for pid in set(matches.values()) & want:
+            frags, mols = expected.setdefault(pid, (list(), list()))
+            (frags if is_frag else mols).append(mol.smiles)
+    assert expected
+
+    with tempfile.NamedTemporaryFile() as f:
+        s = Store(f.name)
+        s.insert_molecules(molecules)
+        s.insert_fragments(fragments)
+        _, got = _main(8, 32, [], f.name, ffname, want, 100)
+    got = {m.pid: (sorted(m.fragments), sorted(m.molecules)) for m in got}
+    expected = {
+        pid: (sorted(f), sorted(m)) for pid, (f, m) in expected.items()
+    }
+    assert got == expected
+
+
+def test_shared_smiles():
+    with tempfile.NamedTemporaryFile() as f:
+        s = Store(f.name)
+        s.insert_molecules(
+            [
+                DBMol("CCO", "inchikey1", 3, 1 << 6 | 1 << 8),
+                DBMol("CCCO", "inchikey2", 4, 1 << 6 | 1 << 8),
+            ]
+        )
+        s.insert_fragments(
+            [
+                DBMol("*CCO", None, 3, 1 << 6 | 1 << 8),
+                DBMol("CCO", None, 3, 1 << 6 | 1 << 8),
+            ]
+        )
+        assert s.get_shared_smiles() == {"CCO"}
+        # CCO is not among the first fragment, so it is not shared
+        assert s.get_shared_smiles(limit=1) == set()
+
+
+def test_query_shared():
+    "SMILES in both tables are labeled once but credited to both"
+    ffname = "openff-2.1.0.offxml"
+    with tempfile.NamedTemporaryFile() as f:
+        s = Store(f.name)
+        s.insert_molecules(
+            [
+                DBMol("CCO", "inchikey1", 3, 1 << 6 | 1 << 8),
+                DBMol("CCCO", "inchikey2", 4, 1 << 6 | 1 << 8),
+            ]
+        )
+        s.insert_fragments(
+            [
+                DBMol("CCO", None, 3, 1 << 6 | 1 << 8),
+                DBMol("*CCO", None, 3, 1 << 6 | 1 << 8),
+            ]
+        )
+        want = {"t1", "t2", "t9"}
+        _, got = _main(8, 32, [], f.name, ffname, want, 100)
+        assert any("CCO" in m.molecules for m in got)
+        for m in got:
+            assert m.molecules.count("CCO") == m.fragments.count("CCO")
+            assert m.molecules.count("CCO") <= 1
+
+        # the fragment is still labeled when the molecule is filtered out
+        with tempfile.NamedTemporaryFile("w") as inchis:
+            inchis.write("inchikey1\n")
+            inchis.flush()
+            filters = parse_filters([f"inchi:{inchis.name}"])
+        _, got = _main(8, 32, filters, f.name, ffname, want, 100)
+        assert any("CCO" in m.fragments for m in got)
+        for m in got:
+            assert "CCO" not in m.molecules
+            assert m.fragments.count("CCO") <= 1
+
+
 def test_mol_to_smiles():
     smiles = "CCO"
     rdk = mol_from_smiles(smiles)
@@ -140,3 +286,54 @@ def test_mapping_debug():
     print(len(got))
     assert len(got) == len(want)
     assert got == want
+
+
+def test_needs_hs():
+    smiles = ["CCOC", "CC(=O)NC", "c1ccccc1CO", "C1CC1C(=O)O"]
+    # patterns matching the same environments with or without explicit Hs
+    same = [
+        "[#6X4:1]-[#6X4:2]-[#8X2:3]-[#6:4]",
+        "[#6H3:1]-[#6:2]",
+        "[#6:1]-[#8;!H0:2]",
+        "[c:1]:[c:2]-[#6X4:3]-[#8:4]",
+    ]
+    # patterns depending on explicit Hs
+    different = [
+        "[*:1]-[#6X4:2]-[#6X4:3]-[*:4]",
+        "[#1:1]-[#6:2]",
+        "[#6:1]-[#6D4:2]",
+        "[#6h3:1]-[#6:2]",
+        "[#6:1]-[#8;h1:2]",
+    ]
+    for smarts in same + different:
+        params = [make_param(smarts, smarts)]
+        pairs = [
+            (
+                find_matches(params, mol_from_smiles(s)),
+                find_matches(params, mol_from_smiles(s, add_hs=False)),
+            )
+            for s in smiles
+        ]
+        assert any(a or b for a, b in pairs), smarts
+        if smarts in same:
+            assert not needs_hs(params[0][1]), smarts
+            assert all(with_hs == without for with_hs, without in pairs)
+        else:
+            assert needs_hs(params[0][1]), smarts
+            assert any(with_hs != without for with_hs, without in pairs)
+
+
+def test_tanimoto():
+    fpgen = AllChem.GetMorganGenerator(radius=2)
+    smiles = ["CCO", "CCOC", "CC(=O)NC", "c1ccccc1CO", "c1ccccc1CCO"]
+    fps = [fpgen.GetFingerprint(mol_from_smiles(s)) for s in smiles]
+    # two empty fingerprints, which DataStructs treats as entirely dissimilar
+    fps.append(DataStructs.ExplicitBitVect(fps[0].GetNumBits()))
+    fps.append(DataStructs.ExplicitBitVect(fps[0].GetNumBits()))
+    got = tanimoto(fps)
+    want = [
+        DataStructs.BulkTanimotoSimilarity(fp, fps, returnDistance=True)
+        for fp in fps
+    ]
+    assert np.allclose(got, want)
+    assert tanimoto([]).shape == (0, 0)
@@ -1,7 +1,8 @@
 import itertools
 import logging
-from functools import partial
-from multiprocessing import Pool
+import math
+from multiprocessing import get_context
+from typing import Callable
 
 import click
 from numpy import loadtxt
@@ -9,10 +10,18 @@ from openff.toolkit import ForceField
 from tqdm import tqdm
 
 from cura.store import DBForceField, DBMol, Match, Store, elements_to_bits
-from cura.utils import find_matches, into_params, mol_from_smiles
+from cura.utils import (
+    find_library_matches,
+    into_params,
+    mol_from_smiles,
+    needs_hs,
+)
 
 logger = logging.getLogger(__name__)
 
+# upper bound on the default number of molecules sent to a worker at once
+MAX_CHUNK_SIZE = 1024
+
 # fmt: off
 PTABLE = [
     "X", "H", "He", "Li", "Be", "B", "C", "N", "O", "F", "Ne", "Na", "Mg",
@@ -28,6 +37,8 @@ PTABLE = [
 ]
 # fmt: on
 
+_SYMBOL_TO_Z = {sym.strip(): z for z, sym in enumerate(PTABLE)}
+
 
 def load_want(filename):
     with open(filename) as inp:
@@ -38,6 +49,37 @@ class Filter:
     def apply(self, mol: DBMol) -> bool:
         raise NotImplementedError()
 
+    @staticmethod
+    def compose(filters: list["Filter"]) -> Callable[[DBMol], bool]:
+        """Combine `filters` into a single function equivalent to
+        `all(f.apply(mol) for f in filters)`. The built-in filters are merged
+        into one element mask, atom count, and set of InChIKeys and checked
+        inline instead of through `apply`"""
+        mask = -1  # every element allowed
+        natoms = math.inf
+        inchis = set()
+        others = []
+        for f in filters:
+            match f:
+                case ElementFilter():
+                    mask &= f.mask
+                case NatomsFilter():
+                    natoms = min(natoms, f.natoms)
+                case InchiFilter():
+                    inchis |= f.inchis
+                case _:
+                    others.append(f)
+
+        def apply(mol: DBMol) -> bool:
+            return (
+                (mol.elements | mask) == mask
+                and mol.natoms <= natoms
+                and mol.inchikey not in inchis
+                and (not others or all(f.apply(mol) for f in others))
+            )
+
+        return apply
+
 
 class ElementFilter(Filter):
     def __init__(self, elements: int):
@@ -61,15 +103,15 @@ class InchiFilter(Filter):
 
     """
 
-    def __init__(self, inchis: list[str]):
-        self.inchis = inchis
+    def __init__(self, inchis: set[str]):
+        self.inchis: set[str] = inchis
 
     def apply(self, mol: DBMol) -> bool:
         return mol.inchikey not in self.inchis
 
 
 def symbols_to_bits(symbols: list[str]) -> int:
-    atomic_nums = [PTABLE.index(sym) for sym in symbols]
+    atomic_nums = [_SYMBOL_TO_Z[sym] for sym in symbols]
     return elements_to_bits(atomic_nums)
 
 
@@ -79,7 +121,8 @@ def parse_filters(filters: list[str]) -> list[Filter]:
         fields = filt.strip().split(":")
         match fields:
             case ["inchi", filename]:
-                ret.append(InchiFilter(loadtxt(filename, dtype=str)))
+                inchis = loadtxt(filename, dtype=str, ndmin=1)
+                ret.append(InchiFilter(set(inchis.tolist())))
             case ["elements", arg]:
                 atomic_symbols = [s.strip() for s in arg.split(",")]
                 ret.append(ElementFilter(symbols_to_bits(atomic_symbols)))
@@ -90,24 +133,148 @@ def parse_filters(filters: list[str]) -> list[Filter]:
     return ret
 
 
+def batched(iterable, n):
+    "Split `iterable` into lists of length `n`, like 3.12's itertools.batched"
+    it = iter(iterable)
+    while batch := list(itertools.islice(it, n)):
+        yield batch
+
+
+def iter_smiles(store, keep, limit, shared: set[str], credited: set[str]):
+    """Yield (smiles, is_frag) pairs for the molecules and then the fragments
+    in `store` passing `keep`. Molecules in `shared` are added to `credited`,
+    and fragments already yielded as molecules this way are skipped"""
+    for m in store.get_molecules(limit):
+        if keep(m):
+            if m.smiles in shared:
+                credited.add(m.smiles)
+            yield m.smiles, False
+    for m in store.get_fragments(limit):
+        if m.smiles not in credited and keep(m):
+            yield m.smiles, True
+
+
+def default_chunk_size(ntasks: int, nprocs: int) -> int:
+    """Split `ntasks` into about four batches per process, but keep each batch
+    small enough that a worker never holds too many molecules at once"""
+    return max(1, min(ntasks // (nprocs * 4), MAX_CHUNK_SIZE))
+
+
+# parameters shared by every task in a worker process. `_init` sets these in
+# the parent before starting a "fork" Pool, so the workers inherit them
+# instead of receiving pickled copies
+_WORKER_STATE = {}
+
+
+def _init(params, want=None):
+    """Set up the state used by `inner`. See `find_library_matches` for
+    `want`"""
+    _WORKER_STATE["params"] = params
+    _WORKER_STATE["want"] = want
+    # molecules only get explicit hydrogens if some parameter needs them
+    _WORKER_STATE["add_hs"] = any(needs_hs(smirks) for _, smirks, _ in params)
+
+
 def inner(
-    pair: tuple[DBMol, bool], params, filters
-) -> tuple[str, set[str], bool]:
-    "Returns a SMILES and its matching parameter IDs"
-    m, is_frag = pair
-    if not all((f.apply(m) for f in filters)):
-        return "", set(), False
-    mol = mol_from_smiles(m.smiles)
-    res = set(find_matches(params, mol).values())
-    if len(res) == 0:
-        logger.warning(f"no matches found for {m.smiles}")
-    return m.smiles, res, is_frag
+    batch: list[tuple[str, bool]],
+) -> tuple[int, int, dict[str, tuple[list[str], list[str]]]]:
+    """Returns the number of SMILES in `batch`, the number of them not matching
+    any desired parameter, and their fragment and molecule SMILES by pid"""
+    params = _WORKER_STATE["params"]
+    want = _WORKER_STATE["want"]
+    add_hs = _WORKER_STATE["add_hs"]
+    mols = [mol_from_smiles(smiles, add_hs) for smiles, _ in batch]
+    res = dict()
+    unmatched = 0
+    for (smiles, is_frag), matches in zip(
+        batch, find_library_matches(params, mols, want)
+    ):
+        pids = set(matches.values())
+        if want is not None:
+            pids &= want
+        elif len(pids) == 0:
+            # only without `want`: with it, most molecules are skipped rather
+            # than unmatched
+            logger.warning(f"no matches found for {smiles}")
+        if not pids:
+            unmatched += 1
+        for pid in pids:
+            fragments, molecules = res.setdefault(pid, (list(), list()))
+            if is_frag:
+                fragments.append(smiles)
+            else:
+                molecules.append(smiles)
+    return len(batch), unmatched, res
+
+
+def label_store(
+    s: Store,
+    params,
+    want,
+    filters,
+    limit,
+    nprocs,
+    chunk_size,
+    pid_to_smirks,
+) -> dict[str, Match]:
+    """Label the molecules and fragments in `s` passing `filters` with
+    `params` on `nprocs` processes, grouped by parameter ID. See
+    `find_library_matches` for `want`"""
+    # the Pool iterates `all_mols`, and thus the cursor of `s`, on its task
+    # handler thread, so `s` must be created with check_same_thread=False.
+    # that is safe as long as this thread leaves `s` alone until the Pool is
+    # done with it
+    res = dict()
+    # SMILES in both tables are only labeled as molecules if the molecule
+    # passes the filters, and are then credited to the fragments once the
+    # matching is done
+    shared = s.get_shared_smiles(limit)
+    credited = set()
+    # filter in the parent so rejected molecules are never sent to a worker.
+    # this is a generator, so rows are only read from the store as the Pool
+    # asks for more work
+    all_mols = iter_smiles(s, Filter.compose(filters), limit, shared, credited)
+    # only an upper bound if any filters are applied
+    total = s.count_molecules(limit) + s.count_fragments(limit) - len(shared)
+    if not chunk_size:
+        chunk_size = default_chunk_size(total, nprocs)
+    unmatched = 0
+    _init(params, want)
+    with (
+        get_context("fork").Pool(processes=nprocs) as p,
+        tqdm(total=total) as pbar,
+    ):
+        for nmols, nunmatched, batch_res in p.imap_unordered(
+            inner, batched(all_mols, chunk_size)
+        ):
+            pbar.update(nmols)
+            unmatched += nunmatched
+            for pid, (fragments, molecules) in batch_res.items():
+                if pid not in res:
+                    res[pid] = Match(pid_to_smirks[pid], pid, list(), list())
+                res[pid].fragments.extend(fragments)
+                res[pid].molecules.extend(molecules)
+
+    for mat in res.values():
+        mat.fragments.extend(smi for smi in mat.molecules if smi in credited)
+
+    logger.warning(f"{unmatched} SMILES not matching desired parameters")
+
+    return res
 
 
 def _main(nprocs, chunk_size, filters, store_name, ffname, want, limit):
-    s = Store(store_name)
+    s = Store(store_name, check_same_thread=False)
     ff = ForceField(ffname)
     params = into_params(ff)
+    # later parameters take precedence over earlier ones, so the ones before
+    # the first wanted parameter can never affect which environments the
+    # wanted parameters end up with
+    first = next(
+        (i for i, (pid, _, _) in enumerate(params) if pid in want),
+        len(params),
+    )
+    params = params[first:]
 
     s.reset_forcefield(ffname)
 
@@ -116,31 +283,9 @@ def _main(nprocs, chunk_size, filters, store_name, ffname, want, limit):
         for p in ff.get_parameter_handler("ProperTorsions").parameters
     }
 
-    res = dict()
-    mols = [(s, False) for s in s.get_molecules(limit)]
-    frags = [(s, True) for s in s.get_fragments(limit)]
-    all_mols = [i for i in itertools.chain(mols, frags)]
-    unmatched = 0
-    with Pool(processes=nprocs) as p:
-        for smiles, matches, is_frag in tqdm(
-            p.imap(
-                partial(inner, params=params, filters=filters),
-                all_mols,
-                chunksize=chunk_size,
-            ),
-            total=len(all_mols),
-        ):
-            for pid in matches & want:
-                if pid not in res:
-                    res[pid] = Match(pid_to_smirks[pid], pid, list(), list())
-                if is_frag:
-                    res[pid].fragments.append(smiles)
-                else:
-                    res[pid].molecules.append(smiles)
-            else:
-                unmatched += 1
-
-    logger.warning(f"{unmatched} SMILES not matching desired parameters")
+    res = label_store(
+        s, params, want, filters, limit, nprocs, chunk_size, pid_to_smirks
+    )
 
     for pid, mat in res.items():
         print(f"{pid} {len(mat.fragments)} frags {len(mat.molecules)} mols")
@@ -157,7 +302,7 @@ def _main(nprocs, chunk_size, filters, store_name, ffname, want, limit):
 
 @click.command()
 @click.option("--nprocs", "-n", default=8)
-@click.option("--chunk-size", "-c", default=32)
+@click.option("--chunk-size", "-c", type=int, default=None)
 @click.option("--filter", "-x", "filters", multiple=True)
 @click.option("--store-name", "-s", default="store.sqlite")
 @click.option("--ffname", "-f", default="openff-2.1.0.offxml")
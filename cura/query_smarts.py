@@ -7,28 +7,25 @@
 # querying, with extracting both "names" (pids) and smirks from a single force
 # field being a special case of the more general behavior here
 
-import itertools
 import logging
-from functools import partial
-from multiprocessing import Pool
 
 import click
 from rdkit import Chem
-from tqdm import tqdm
 
-from cura.query import inner, parse_filters
-from cura.store import DBForceField, Match, Store
+from cura.query import label_store, parse_filters
+from cura.store import DBForceField, Store
+from cura.utils import make_param
 
 logger = logging.getLogger(__name__)
 
 
-def load_want(filename) -> list[tuple[str, Chem.Mol]]:
+def load_want(filename) -> list[tuple[str, Chem.Mol, tuple[int, ...]]]:
     params = []
     name_to_smirks = dict()
     with open(filename) as f:
         for line in f:
             [smarts, name] = line.split()
-            params.append((name, Chem.MolFromSmarts(smarts)))
+            params.append(make_param(name, smarts))
             name_to_smirks[name] = smarts
     return params, name_to_smirks
 
@@ -43,35 +40,13 @@ def _main(
     limit,
     pid_to_smirks,
 ):
-    s = Store(store_name)
+    s = Store(store_name, check_same_thread=False)
 
     s.reset_forcefield(ffname)
 
-    res = dict()
-    mols = [(s, False) for s in s.get_molecules(limit)]
-    frags = [(s, True) for s in s.get_fragments(limit)]
-    all_mols = [i for i in itertools.chain(mols, frags)]
-    unmatched = 0
-    with Pool(processes=nprocs) as p:
-        for smiles, matches, is_frag in tqdm(
-            p.imap(
-                partial(inner, params=params, filters=filters),
-                all_mols,
-                chunksize=chunk_size,
-            ),
-            total=len(all_mols),
-        ):
-            for pid in matches:
-                if pid not in res:
-                    res[pid] = Match(pid_to_smirks[pid], pid, list(), list())
-                if is_frag:
-                    res[pid].fragments.append(smiles)
-                else:
-                    res[pid].molecules.append(smiles)
-            else:
-                unmatched += 1
-
-    logger.warning(f"{unmatched} SMILES not matching desired parameters")
+    res = label_store(
+        s, params, None, filters, limit, nprocs, chunk_size, pid_to_smirks
+    )
 
     for pid, mat in res.items():
         print(f"{pid} {len(mat.fragments)} frags {len(mat.molecules)} mols")
@@ -88,7 +63,7 @@ def _main(
 
 @click.command()
 @click.option("--nprocs", "-n", default=8)
-@click.option("--chunk-size", "-c", default=32)
+@click.option("--chunk-size", "-c", type=int, default=None)
 @click.option("--filter", "-x", "filters", multiple=True)
 @click.option("--store-name", "-s", default="store.sqlite")
 @click.option("--target-params", "-t", default="want.params")
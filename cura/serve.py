@@ -15,12 +15,17 @@ from rdkit import Chem
 from rdkit.Chem import AllChem
 from rdkit.Chem.Draw import rdDepictor, rdMolDraw2D
 
-from query import PTABLE, find_matches, into_params, mol_from_smiles
+from query import PTABLE
 from store import Store
 from utils import (
+    cached_mol_from_smiles,
+    find_matches,
     find_smallest,
+    into_params,
+    make_param,
     make_svg,
     mol_from_mapped_smiles,
+    mol_from_smiles,
     mol_to_smiles,
     mol_to_svg,
     openff_clean,
@@ -62,7 +67,7 @@ else:
         for line in inp:
             smarts, label = line.split()
             pid_to_smarts[label] = smarts
-            mol_map.append((label, Chem.MolFromSmarts(smarts)))
+            mol_map.append(make_param(label, smarts))
 
 
 PID_RE = re.compile("(t)([0-9]+)(.*)")
@@ -166,7 +171,7 @@ def get_smiles_list(table, ffname, pid) -> list[tuple[Chem.Mol, str, int]]:
     smiles_list = table.get_smiles_matching(ffname, pid)
     mols = []
     for s in smiles_list:
-        mol = mol_from_smiles(s)
+        mol = cached_mol_from_smiles(s)
         natoms = mol.GetNumAtoms()
         mols.append((mol, s, natoms))
     mols = sorted(mols, key=lambda k: k[2])  # sort by natoms
@@ -214,7 +219,7 @@ class Report:
     clusters: list[list[int]]
     mols: list[Chem.Mol]
     map: dict[str, str]
-    mol_map: list[tuple[str, Chem.Mol]]
+    mol_map: list[tuple[str, Chem.Mol, tuple[int, ...]]]
 
 
 def make_fps(mols: list[Chem.Mol], radius: int):
@@ -262,7 +267,10 @@ def make_cluster_report(ffname, mols, eps, min_pts) -> Report:
 def cluster(pid):
     smarts = pid_to_smarts[pid]
     table = Store.quick()
-    mols = [mol_from_smiles(s) for s in table.get_smiles_matching(ffname, pid)]
+    mols = [
+        cached_mol_from_smiles(s)
+        for s in table.get_smiles_matching(ffname, pid)
+    ]
     DBSCAN_EPS = 0.5
     DBSCAN_MIN_PTS = 1
 
@@ -328,7 +336,7 @@ CANVAS_SIZE = 400  # size of html canvas
 def edit_molecule():
     data = request.get_json()
     smiles, pid = data["smiles"], data["pid"]
-    mol = mol_from_smiles(smiles)
+    mol = cached_mol_from_smiles(smiles)
     mol, ret = mol_to_js(mol, pid)
     global CUR_EDIT_MOL
     CUR_EDIT_MOL = mol
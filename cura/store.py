@@ -97,8 +97,14 @@ class DBForceField:
 
 
 class Store:
-    def __init__(self, filename="store.sqlite", nprocs=8):
-        self.con = sqlite3.connect(filename)
+    def __init__(
+        self, filename="store.sqlite", nprocs=8, check_same_thread=True
+    ):
+        """Connect to `filename`, creating the tables if needed.
+        `check_same_thread` is passed to `sqlite3.connect`"""
+        self.con = sqlite3.connect(
+            filename, check_same_thread=check_same_thread
+        )
         self.cur = self.con.cursor()
         self.cur.arraysize = 1024
         self.cur.execute(
@@ -227,6 +233,21 @@ class Store:
         "Return a count of rows in the database"
         return self.cur.execute("SELECT COUNT(*) FROM molecules").fetchone()[0]
 
+    def count_molecules(self, limit=None) -> int:
+        "Return the number of rows that `get_molecules(limit)` will yield"
+        return self._count_rows("molecules", limit)
+
+    def count_fragments(self, limit=None) -> int:
+        "Return the number of rows that `get_fragments(limit)` will yield"
+        return self._count_rows("fragments", limit)
+
+    def _count_rows(self, tablename: str, limit=None) -> int:
+        res = self.cur.execute(f"SELECT COUNT(*) FROM {tablename}")
+        count = res.fetchone()[0]
+        if limit:
+            count = min(count, int(limit))
+        return count
+
     def get_smiles(self, limit=None) -> Iterator[str]:
         "Return an iterator over SMILES in the database"
         if limit:
@@ -258,7 +279,7 @@ class Store:
                 DBMol(
                     id=x[0],
                     smiles=x[1],
-                    inchikey=[2],
+                    inchikey=x[2],
                     natoms=x[3],
                     elements=int.from_bytes(x[4], "big"),
                     tag=x[5],
@@ -269,6 +290,18 @@ class Store:
     def get_fragments(self, limit=None) -> Iterator[DBMol]:
         return self._get_dbmols("fragments", limit)
 
+    def get_shared_smiles(self, limit=None) -> set[str]:
+        """Return the SMILES found in both the first `limit` fragments and the
+        first `limit` molecules"""
+        res = self.cur.execute(
+            """SELECT smiles FROM (SELECT smiles FROM fragments LIMIT ?1)
+            INTERSECT
+            SELECT smiles FROM (SELECT smiles FROM molecules LIMIT ?1)""",
+            # a negative LIMIT means no limit in SQLite
+            (limit or -1,),
+        )
+        return {x[0] for x in res.fetchall()}
+
     def _get_dbmols(self, tablename: str, limit=None) -> Iterator[DBMol]:
         if limit:
             res = self.cur.execute(
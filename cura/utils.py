@@ -1,15 +1,32 @@
+from functools import lru_cache
+
 import numpy as np
-from rdkit import Chem, DataStructs
+from rdkit import Chem
+from rdkit.Chem import rdSubstructLibrary
 from rdkit.Chem.Draw import MolsToGridImage, rdDepictor, rdMolDraw2D
 
 
-def mol_from_smiles(smiles: str) -> Chem.Mol:
+def mol_from_smiles(smiles: str, add_hs: bool = True) -> Chem.Mol:
     """Create an RDKit molecule from SMILES and perform the cleaning operations
-    from the OpenFF toolkit
+    from the OpenFF toolkit. See `openff_clean` for `add_hs`
 
     """
     rdmol = Chem.MolFromSmiles(smiles)
-    return openff_clean(rdmol)
+    return openff_clean(rdmol, add_hs)
+
+
+def cached_mol_from_smiles(smiles: str) -> Chem.Mol:
+    """Like `mol_from_smiles`, but cache the cleaned molecules by SMILES for
+    callers that build the same molecules repeatedly, like `serve.py`. This
+    returns a copy that is safe to modify.
+
+    """
+    return Chem.Mol(_cached_mol_from_smiles(smiles))
+
+
+@lru_cache(maxsize=4096)
+def _cached_mol_from_smiles(smiles: str) -> Chem.Mol:
+    return mol_from_smiles(smiles)
 
 
 def mol_from_smarts(smarts: str) -> Chem.Mol:
@@ -21,7 +38,12 @@ def mol_from_smarts(smarts: str) -> Chem.Mol:
     return openff_clean(rdmol)
 
 
-def openff_clean(rdmol: Chem.Mol) -> Chem.Mol:
+def openff_clean(rdmol: Chem.Mol, add_hs: bool = True) -> Chem.Mol:
+    """Sanitize `rdmol` like the OpenFF toolkit does. Setting `add_hs` to False
+    skips adding explicit hydrogens, which is only safe for SMARTS patterns
+    without `needs_hs`
+
+    """
     Chem.SanitizeMol(
         rdmol,
         Chem.SanitizeFlags.SANITIZE_ALL
@@ -30,24 +52,56 @@ def openff_clean(rdmol: Chem.Mol) -> Chem.Mol:
     )
     Chem.SetAromaticity(rdmol, Chem.AromaticityModel.AROMATICITY_MDL)
     Chem.AssignStereochemistry(rdmol)
-    rdmol = Chem.AddHs(rdmol)
+    if add_hs:
+        rdmol = Chem.AddHs(rdmol)
     return rdmol
 
 
-def find_smarts_matches(mol, smirks: Chem.Mol):
-    "Adapted from RDKitToolkitWrapper._find_smarts_matches"
+def needs_hs(smirks: Chem.Mol) -> bool:
+    """Conservatively report whether matching `smirks` might depend on
+    explicit hydrogens"""
+    smarts = Chem.MolToSmarts(smirks)
+    # recursive SMARTS, chirality, degree (D), and implicit hydrogen count (h)
+    # change when hydrogens become explicit atoms, while primitives like H, X,
+    # and v count both kinds of hydrogen
+    if any(c in smarts for c in "$@Dh"):
+        return True
+    return any(atom.GetAtomicNum() <= 1 for atom in smirks.GetAtoms())
+
+
+_MATCH_KWARGS = dict(
+    uniquify=False, maxMatches=np.iinfo(np.uintc).max, useChirality=True
+)
+
+
+def get_map_list(smirks: Chem.Mol) -> tuple[int, ...]:
+    "Return the indices of the mapped atoms in `smirks` in atom map order"
     idx_map = dict()
     for atom in smirks.GetAtoms():
         smirks_index = atom.GetAtomMapNum()
         if smirks_index != 0:
             idx_map[smirks_index - 1] = atom.GetIdx()
-    map_list = [idx_map[x] for x in sorted(idx_map)]
+    return tuple(idx_map[x] for x in sorted(idx_map))
+
+
+@lru_cache(maxsize=None)
+def _compile_smarts(smarts: str) -> Chem.Mol:
+    """Parse `smarts`, reusing the Mol for repeated patterns. The result is
+    shared, so it should only be used as a query"""
+    return Chem.MolFromSmarts(smarts)
 
-    max_matches = np.iinfo(np.uintc).max
-    match_kwargs = dict(
-        uniquify=False, maxMatches=max_matches, useChirality=True
-    )
-    full_matches = mol.GetSubstructMatches(smirks, **match_kwargs)
+
+def make_param(id: str, smarts: str) -> tuple[str, Chem.Mol, tuple[int, ...]]:
+    """Build the id, SMARTS Mol, and map list triple expected by `find_matches`
+    and friends"""
+    smirks = _compile_smarts(smarts)
+    return id, smirks, get_map_list(smirks)
+
+
+def find_smarts_matches(mol, smirks: Chem.Mol, map_list: tuple[int, ...]):
+    """Adapted from RDKitToolkitWrapper._find_smarts_matches. `map_list` should
+    be the result of `get_map_list(smirks)`"""
+    full_matches = mol.GetSubstructMatches(smirks, **_MATCH_KWARGS)
 
     matches = [tuple(match[x] for x in map_list) for match in full_matches]
 
@@ -55,14 +109,14 @@ def find_smarts_matches(mol, smirks: Chem.Mol):
 
 
 def find_matches(
-    params: list[tuple[str, Chem.Mol]], mol: Chem.Mol
+    params: list[tuple[str, Chem.Mol, tuple[int, ...]]], mol: Chem.Mol
 ) -> dict[tuple[int], str]:
     """Returns a map of chemical environment tuples to their matching parameter
     ids. Modeled (loosely) after ForceField.label_molecules and
     ParameterHandler._find_matches"""
     matches = {}
-    for id, smirks in params:
-        env_matches = find_smarts_matches(mol, smirks)
+    for id, smirks, map_list in params:
+        env_matches = find_smarts_matches(mol, smirks, map_list)
         for mat in env_matches:
             if mat[0] > mat[-1]:
                 mat = mat[::-1]
@@ -70,6 +124,60 @@ def find_matches(
     return matches
 
 
+def make_library(
+    mols: list[Chem.Mol],
+) -> rdSubstructLibrary.SubstructLibrary:
+    """Build a SubstructLibrary over `mols`, with pattern fingerprints to
+    screen out molecules before the full substructure search"""
+    library = rdSubstructLibrary.SubstructLibrary(
+        rdSubstructLibrary.MolHolder(), rdSubstructLibrary.PatternHolder()
+    )
+    for mol in mols:
+        library.AddMol(mol)
+    return library
+
+
+_LIBRARY_KWARGS = dict(useChirality=True, numThreads=1, maxResults=-1)
+
+
+def find_library_matches(
+    params: list[tuple[str, Chem.Mol, tuple[int, ...]]],
+    mols: list[Chem.Mol],
+    want: set[str] | None = None,
+) -> list[dict[tuple[int], str]]:
+    """Like `find_matches` but for a whole sequence of molecules at once. If
+    `want` is provided, molecules not assigned any of those ids may get empty
+    maps"""
+    # looping over `params` first and only searching the molecules in the
+    # library matching each one still lets later parameters take precedence
+    # over earlier ones
+    ret = [dict() for _ in mols]
+    if len(mols) == 0:
+        # GetMatches raises on an empty library
+        return ret
+    library = make_library(mols)
+    if want is not None:
+        # a wanted parameter can't be assigned to a molecule it doesn't match
+        # at all, so there's no need to label any of the others
+        hits = set()
+        for id, smirks, _ in params:
+            if id in want:
+                hits.update(library.GetMatches(smirks, **_LIBRARY_KWARGS))
+                if len(hits) == len(mols):
+                    break
+        if len(hits) == 0:
+            # an empty search order searches the whole library
+            return ret
+        library.SetSearchOrder(sorted(hits))
+    for id, smirks, map_list in params:
+        for idx in library.GetMatches(smirks, **_LIBRARY_KWARGS):
+            for mat in find_smarts_matches(mols[idx], smirks, map_list):
+                if mat[0] > mat[-1]:
+                    mat = mat[::-1]
+                ret[idx][mat] = id
+    return ret
+
+
 def make_svg(pid, map, mol_map, mol) -> tuple[list[str], list[list[int]]]:
     """Returns a sequence of SVGs corresponding to each match for `pid` in
     `mol`, along with the corresponding list of chemical environment tuples.
@@ -96,16 +204,17 @@ def mol_to_svg(
     if len(hl_atoms) == 0:
         hl_atoms = [[]]
 
+    # none of this depends on the highlighted atoms, so only do it once
+    rdDepictor.SetPreferCoordGen(True)
+    rdDepictor.Compute2DCoords(mol)
+    rdmol = rdMolDraw2D.PrepareMolForDrawing(mol)
+    # PrepareMolForDrawing returns a copy, and I asserted that `mol` still
+    # had mapping numbers after doing this
+    for atom in rdmol.GetAtoms():
+        atom.SetAtomMapNum(0)
+
     ret = []
     for hl in hl_atoms:
-        rdDepictor.SetPreferCoordGen(True)
-        rdDepictor.Compute2DCoords(mol)
-        rdmol = rdMolDraw2D.PrepareMolForDrawing(mol)
-        # PrepareMolForDrawing returns a copy, and I asserted that `mol` still
-        # had mapping numbers after doing this
-        for atom in rdmol.GetAtoms():
-            atom.SetAtomMapNum(0)
-
         ret.append(
             MolsToGridImage(
                 [rdmol],
@@ -153,23 +262,38 @@ def mol_from_mapped_smiles(smiles) -> Chem.Mol:
     return ret
 
 
-def into_params(ff) -> list[tuple[str, Chem.Mol]]:
-    "Convert a ForceField into a sequence of pid:Mol pairs"
+def into_params(ff) -> list[tuple[str, Chem.Mol, tuple[int, ...]]]:
+    "Convert a ForceField into a sequence of pid, Mol, map list triples"
     return [
-        (p.id, Chem.MolFromSmarts(p.smirks))
+        make_param(p.id, p.smirks)
         for p in ff.get_parameter_handler("ProperTorsions").parameters
     ]
 
 
+def fps_to_bits(fps) -> np.ndarray:
+    """Unpack a list of bit vector fingerprints into an array of 0s and 1s.
+    float32 is exact for any realistic count of bits and much faster than
+    integer types in matrix multiplications"""
+    if len(fps) == 0:
+        return np.zeros((0, 0), dtype=np.float32)
+    ret = np.zeros((len(fps), fps[0].GetNumBits()), dtype=np.float32)
+    for row, fp in enumerate(fps):
+        ret[row, list(fp.GetOnBits())] = 1
+    return ret
+
+
 def tanimoto(fps):
     "Compute the tanimoto distance matrix for a list of fingerprints"
-    n = len(fps)
-    ret = np.zeros((n, n))
-    for row in range(n):
-        ret[row, row:] = np.array(
-            DataStructs.BulkTanimotoSimilarity(
-                fps[row], fps[row:], returnDistance=True
-            )
-        )
-
-    return ret + ret.T  # copy upper triangle to lower, diag is already zero
+    bits = fps_to_bits(fps)
+    # the dot product of two rows of 0s and 1s counts their common bits, so
+    # this gets every pairwise intersection in a single matrix multiplication.
+    # everything after that is done in place on the n x n arrays
+    ret = (bits @ bits.T).astype(np.float64)
+    counts = bits.sum(axis=1, dtype=np.float64)
+    union = np.add.outer(counts, counts)
+    union -= ret
+    # like DataStructs, two empty fingerprints have a similarity of 0, which
+    # their intersection in `ret` already is
+    np.divide(ret, union, out=ret, where=union > 0)
+    np.subtract(1.0, ret, out=ret)
+    return ret